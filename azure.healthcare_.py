@@ -1,15 +1,19 @@
 import csv
 import json
 import os
+import sys
 import textwrap
-import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
-from azure.cosmos import CosmosClient
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from twilio.rest import Client
+
+try:
+    import orjson
+except ImportError:  # optional: faster JSON decoding, stdlib json otherwise
+    orjson = None
 
 SCOPES = [
     "https://www.googleapis.com/auth/fitness.heart_rate.read",
@@ -36,20 +40,85 @@ EMERGENCY_CONTACTS = [
 COSMOS_CONN_STR = os.getenv("COSMOS_CONN_STR", "connection_string")
 COSMOS_DB_NAME = os.getenv("COSMOS_DB_NAME", "FitVitals")
 COSMOS_COLL = os.getenv("COSMOS_COLL", "Vitals")
+COSMOS_MAX_WORKERS = int(os.getenv("COSMOS_MAX_WORKERS", "10"))
+COSMOS_BATCH_SIZE = 100
+COSMOS_BULK_SPROC_ID = "bulkUpsert"
+
+# Server-side upsert of an array of documents within one partition. Stops early
+# if the script nears its execution limit and reports how many it wrote, so the
+# caller can resubmit the remainder.
+COSMOS_BULK_SPROC_BODY = """
+function bulkUpsert(docs) {
+    var collection = getContext().getCollection();
+    var link = collection.getSelfLink();
+    var count = 0;
+
+    if (!docs || !docs.length) {
+        getContext().getResponse().setBody(0);
+        return;
+    }
+    upsert(docs[count]);
+
+    function upsert(doc) {
+        if (!collection.upsertDocument(link, doc, onUpserted)) {
+            getContext().getResponse().setBody(count);
+        }
+    }
+
+    function onUpserted(err) {
+        if (err) throw err;
+        count++;
+        if (count < docs.length) {
+            upsert(docs[count]);
+        } else {
+            getContext().getResponse().setBody(count);
+        }
+    }
+}
+"""
 
 TRIAL_ACCOUNT = os.getenv("TRIAL_ACCOUNT", "true").lower() in ("1", "true", "yes")
 SMS_CHAR_LIMIT = int(os.getenv("SMS_CHAR_LIMIT", "140"))
 
+# Data type keywords and their canonical Google Fit data type names
+FIT_DATA_TYPES = {
+    "heart_rate": "com.google.heart_rate.bpm",
+    "oxygen_saturation": "com.google.oxygen_saturation",
+}
+
 # Timezones
 IST = timezone(timedelta(hours=5, minutes=30))
 UTC = timezone.utc
 
+def _json_loads(content):
+    return orjson.loads(content) if orjson else json.loads(content)
+
+@lru_cache(maxsize=1)
+def _fit_model():
+    """googleapiclient response model that decodes with orjson, or None to use the default."""
+    if orjson is None:
+        return None
+    from googleapiclient.model import JsonModel
+
+    class OrjsonModel(JsonModel):
+        def deserialize(self, content):
+            try:
+                body = orjson.loads(content)
+            except orjson.JSONDecodeError:
+                return content.decode("utf-8") if isinstance(content, bytes) else content
+            if self._data_wrapper and "data" in body:
+                body = body["data"]
+            return body
+
+    return OrjsonModel()
+
+@lru_cache(maxsize=1)
 def get_credentials():
     """Resolve Google credentials from env, token file, or interactive flow."""
     token_env = os.getenv("GOOGLE_TOKEN")
     if token_env:
         try:
-            info = json.loads(token_env)
+            info = _json_loads(token_env)
             return Credentials.from_authorized_user_info(info, SCOPES)
         except Exception as e:
             print("⚠️ GOOGLE_TOKEN present but could not parse:", e)
@@ -61,6 +130,8 @@ def get_credentials():
             print("⚠️ Failed reading token file:", e)
 
     if Path(CLIENT_SECRET).exists():
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET, SCOPES)
         creds = flow.run_local_server(port=8282, access_type="offline", prompt="consent")
         Path(TOKEN_FILE).write_text(creds.to_json(), encoding="utf-8")
@@ -70,125 +141,219 @@ def get_credentials():
         "No Google credentials: set GOOGLE_TOKEN env or provide token.json and client_secret.json."
     )
 
-def get_dataset(service, data_type_keyword: str, days: int = 1):
+@lru_cache(maxsize=1)
+def get_fit_service():
+    """Build the Fit API client once per process; building it parses the discovery document."""
+    from googleapiclient.discovery import build
+
+    return build("fitness", "v1", credentials=get_credentials(), model=_fit_model())
+
+def _dataset_id(days):
     end_time = datetime.now(timezone.utc)
     start_time = end_time - timedelta(days=days)
-    dataset_id = f"{int(start_time.timestamp() * 1e9)}-{int(end_time.timestamp() * 1e9)}"
+    return f"{int(start_time.timestamp() * 1e9)}-{int(end_time.timestamp() * 1e9)}"
+
+@lru_cache(maxsize=1)
+def _resolve_sources(service):
+    """Map each FIT_DATA_TYPES keyword to its dataStreamId with one listing call."""
+    ds_list = (
+        service.users()
+        .dataSources()
+        .list(userId="me", dataTypeName=list(FIT_DATA_TYPES.values()))
+        .execute()
+    )
+    keyword_by_type = {name: keyword for keyword, name in FIT_DATA_TYPES.items()}
+    sources = {}
+    for ds in ds_list.get("dataSource", []):
+        keyword = keyword_by_type.get(ds.get("dataType", {}).get("name"))
+        if keyword:
+            sources.setdefault(keyword, ds.get("dataStreamId"))
+    return sources
 
+def _resolve_source(service, data_type_keyword):
     try:
-        ds_list = service.users().dataSources().list(userId="me").execute()
+        target_source = _resolve_sources(service).get(data_type_keyword)
     except Exception as e:
         print("❌ Failed to list data sources:", e)
-        return []
-
-    target_source = None
-    for ds in ds_list.get("dataSource", []):
-        ds_id = ds.get("dataStreamId", "").lower()
-        dt_name = ds.get("dataType", {}).get("name", "").lower()
-        if data_type_keyword.lower() in ds_id or data_type_keyword.lower() in dt_name:
-            target_source = ds.get("dataStreamId")
-            break
+        return None
 
     if not target_source:
         print(f"❌ No data source found for {data_type_keyword}")
-        return []
+        # Don't keep a negative result: the source may appear once the device syncs.
+        _resolve_sources.cache_clear()
+    return target_source
 
-    try:
-        dataset_response = (
-            service.users()
-            .dataSources()
-            .datasets()
-            .get(userId="me", dataSourceId=target_source, datasetId=dataset_id)
-            .execute()
-        )
-    except Exception as e:
-        print("❌ Failed to fetch dataset:", e)
-        return []
+def _dataset_request(service, target_source, dataset_id):
+    return (
+        service.users()
+        .dataSources()
+        .datasets()
+        .get(userId="me", dataSourceId=target_source, datasetId=dataset_id)
+    )
 
-    points = []
+def _iter_points(dataset_response):
     for point in dataset_response.get("point", []):
-        ts = int(point.get("startTimeNanos", 0)) / 1e9
-        utc_time = datetime.fromtimestamp(ts, timezone.utc)
-        ist_time = utc_time.astimezone(IST)
+        ts_ns = int(point.get("startTimeNanos", 0))
+        ist_time = datetime.fromtimestamp(ts_ns / 1e9, IST)
         val = None
         v = point.get("value", [])
         if v:
             val = v[0].get("fpVal") if "fpVal" in v[0] else v[0].get("intVal")
-        if val is not None:
-            points.append((ist_time.isoformat(), val))  # return IST ISO string
-    return points
+        # fpVal/intVal decode as JSON numbers; anything else is not a reading.
+        if isinstance(val, (int, float)) and not isinstance(val, bool):
+            yield ist_time.isoformat(), val, ts_ns  # IST ISO string, value, Fit epoch ns
+
+def get_dataset(service, data_type_keyword: str, days: int = 1):
+    """Return (IST ISO timestamp, value, epoch ns) tuples for a single data type."""
+    return get_datasets(service, (data_type_keyword,), days=days)[data_type_keyword]
+
+def get_datasets(service, data_type_keywords, days: int = 1):
+    """Fetch several data types in one batched HTTP request.
+
+    Returns a dict mapping each keyword to a list of (IST ISO timestamp, value,
+    epoch ns) tuples; keywords that could not be fetched map to an empty list.
+    """
+    dataset_id = _dataset_id(days)
+    responses = {}
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            print(f"❌ Failed to fetch dataset for {request_id}:", exception)
+        else:
+            responses[request_id] = response
+
+    # The service's HTTP transport is not thread-safe, so coalesce the
+    # dataset reads into a single batch request rather than using threads.
+    batch = service.new_batch_http_request(callback=collect)
+    pending = 0
+    for keyword in data_type_keywords:
+        target_source = _resolve_source(service, keyword)
+        if target_source:
+            batch.add(_dataset_request(service, target_source, dataset_id), request_id=keyword)
+            pending += 1
+
+    if pending:
+        try:
+            batch.execute()
+        except Exception as e:
+            print("❌ Failed to fetch datasets:", e)
+
+    return {keyword: list(_iter_points(responses.get(keyword, {}))) for keyword in data_type_keywords}
 
 def save_to_csv(heart_data, spo2_data):
-    with open(CSV_FILE, "w", newline="", encoding="utf-8") as f:
+    # 1 MiB buffer: rows accumulate in memory and hit the disk in a few large writes.
+    with open(CSV_FILE, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
         writer = csv.writer(f)
         writer.writerow(["Timestamp (IST)", "Heart Rate (bpm)", "SpO₂ (%)"])
-        all_times = sorted(set([t for t, _ in heart_data] + [t for t, _ in spo2_data]))
-        for t in all_times:
-            hr = next((v for ts, v in heart_data if ts == t), "")
-            sp = next((v for ts, v in spo2_data if ts == t), "")
-            writer.writerow([t, hr, sp])
+        hr_map = {t: v for t, v, _ in heart_data}
+        sp_map = {t: v for t, v, _ in spo2_data}
+        all_times = sorted(set(hr_map).union(sp_map))
+        writer.writerows((t, hr_map.get(t, ""), sp_map.get(t, "")) for t in all_times)
     print(f"✅ Data saved to {CSV_FILE}")
 
+@lru_cache(maxsize=1)
+def _cosmos_container():
+    """Build the container client once per process so its connection pool is reused."""
+    from azure.cosmos import CosmosClient
+
+    client = CosmosClient.from_connection_string(COSMOS_CONN_STR)
+    database = client.get_database_client(COSMOS_DB_NAME)
+    return database.get_container_client(COSMOS_COLL)
+
 def get_cosmos_collection():
     if not COSMOS_CONN_STR:
         print("ℹ️ COSMOS_CONN_STR not set; skipping DB save.")
         return None
     try:
-        client = CosmosClient.from_connection_string(COSMOS_CONN_STR)
-        database = client.get_database_client(COSMOS_DB_NAME)
-        container = database.get_container_client(COSMOS_COLL)
-        try:
-            _ = container.read()
-        except Exception:
-            pass
-        return container
+        return _cosmos_container()
     except Exception as e:
         print("⚠️ Cosmos DB init failed; skipping DB save:", e)
         return None
 
 
+def _iter_docs(heart_data, spo2_data, user_id):
+    ingested_at = datetime.now(UTC).isoformat()  # one ingestion time per save
+    for field, suffix, series in (("heart_rate", "hr", heart_data), ("spo2", "sp", spo2_data)):
+        for _, val, ts_ns in series:
+            yield {
+                # Deterministic id: re-running over the same window overwrites
+                # rather than duplicating, so retries are safe.
+                "id": f"{user_id}-{ts_ns}-{suffix}",
+                "userId": user_id,
+                "timestamp": datetime.fromtimestamp(ts_ns / 1e9, UTC).isoformat(),
+                field: float(val),
+                "ingested_at": ingested_at,
+            }
+
+
+@lru_cache(maxsize=1)
+def _bulk_upsert_sproc(container):
+    """Register the bulk upsert stored procedure once per process and return its id."""
+    from azure.cosmos.exceptions import CosmosResourceExistsError
+
+    try:
+        container.scripts.create_stored_procedure(
+            {"id": COSMOS_BULK_SPROC_ID, "body": COSMOS_BULK_SPROC_BODY}
+        )
+    except CosmosResourceExistsError:
+        pass
+    return COSMOS_BULK_SPROC_ID
+
+
 def save_to_cosmos(heart_data, spo2_data, user_id="user123"):
     container = get_cosmos_collection()
     if not container:
         return
 
-    docs = []
+    try:
+        sproc_id = _bulk_upsert_sproc(container)
+    except Exception as e:
+        print("⚠️ Bulk upsert procedure unavailable; writing docs one by one:", e)
+        sproc_id = None
 
-    for t, hr in heart_data:
-        try:
-            docs.append(
-                {
-                    "id": str(uuid.uuid4()),
-                    "userId": user_id,
-                    "timestamp": datetime.fromisoformat(t).astimezone(UTC).isoformat(),
-                    "heart_rate": float(hr),
-                    "ingested_at": datetime.now(UTC).isoformat(),
-                }
-            )
-        except Exception:
-            continue
-
-    for t, sp in spo2_data:
+    def upsert_one(doc):
         try:
-            docs.append(
-                {
-                    "id": str(uuid.uuid4()),
-                    "userId": user_id,
-                    "timestamp": datetime.fromisoformat(t).astimezone(UTC).isoformat(),
-                    "spo2": float(sp),
-                    "ingested_at": datetime.now(UTC).isoformat(),
-                }
-            )
-        except Exception:
-            continue
-
-    for doc in docs:
-        try:
-            container.create_item(doc)
+            container.upsert_item(doc)
+            return True
         except Exception as e:
             print("⚠️ Failed to insert doc:", e)
-
-    print(f"✅ Inserted {len(docs)} records into Cosmos DB for user {user_id}")
+            return False
+
+    def upsert_batch(batch):
+        nonlocal sproc_id
+        done = 0
+        if sproc_id is not None:
+            # Every doc in a save shares userId (the partition key), so one
+            # procedure call writes the whole batch in a single round trip.
+            try:
+                while done < len(batch):
+                    written = container.scripts.execute_stored_procedure(
+                        sproc_id, partition_key=user_id, params=[batch[done:]]
+                    )
+                    if not written:
+                        raise RuntimeError("procedure made no progress")
+                    done += written
+            except Exception as e:
+                # e.g. the container is not partitioned on /userId, or one doc
+                # rolled back the transaction; stop using the procedure for this save.
+                print("⚠️ Bulk upsert failed; writing remaining docs one by one:", e)
+                sproc_id = None
+        return done + sum(upsert_one(doc) for doc in batch[done:])
+
+    # Build documents one batch at a time and keep at most COSMOS_MAX_WORKERS
+    # batches in flight, so only those batches are ever held in memory.
+    docs = _iter_docs(heart_data, spo2_data, user_id)
+    inserted = 0
+    with ThreadPoolExecutor(max_workers=COSMOS_MAX_WORKERS) as ex:
+        pending = set()
+        while batch := list(islice(docs, COSMOS_BATCH_SIZE)):
+            if len(pending) >= COSMOS_MAX_WORKERS:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                inserted += sum(f.result() for f in finished)
+            pending.add(ex.submit(upsert_batch, batch))
+        inserted += sum(f.result() for f in pending)
+
+    print(f"✅ Inserted {inserted} records into Cosmos DB for user {user_id}")
 
 def shorten_message(latest_hr, latest_spo2, timestamp, hospitals_link):
     base = f"HR:{latest_hr}bpm SpO₂:{latest_spo2}% Time:{timestamp} "
@@ -214,73 +379,102 @@ def create_alert_message(latest_hr, latest_spo2, hospitals_link):
     )
 
 
+@lru_cache(maxsize=1)
+def _twilio_client():
+    # The REST client holds an HTTP session; build it once and share it across sends.
+    from twilio.rest import Client
+
+    return Client(TWILIO_SID, TWILIO_AUTH_TOKEN)
+
+
 def send_twilio_alert(message):
     if not (TWILIO_SID and TWILIO_AUTH_TOKEN and TWILIO_PHONE and EMERGENCY_CONTACTS):
         print("⚠️ Twilio config incomplete; skipping SMS.")
         return
     try:
-        client = Client(TWILIO_SID, TWILIO_AUTH_TOKEN)
+        client = _twilio_client()
     except Exception as e:
         print("⚠️ Twilio client init failed:", e)
         return
 
-    chunks = textwrap.wrap(message, SMS_CHAR_LIMIT, break_long_words=False, replace_whitespace=False)
-    for i, chunk in enumerate(chunks, 1):
-        for number in EMERGENCY_CONTACTS:
+    # With only spaces/newlines as whitespace, wrap() would return this message
+    # unchanged as one chunk minus trailing whitespace (the usual TRIAL_ACCOUNT case).
+    if (
+        len(message) <= SMS_CHAR_LIMIT
+        and message.strip()
+        and all(c in " \n" or not c.isspace() for c in message)
+    ):
+        chunks = [message.rstrip()]
+    else:
+        chunks = textwrap.wrap(message, SMS_CHAR_LIMIT, break_long_words=False, replace_whitespace=False)
+    n_chunks = len(chunks)
+    sends = [
+        (f"Part {i}/{n_chunks}: {chunk}" if n_chunks > 1 else chunk, number)
+        for i, chunk in enumerate(chunks, 1)
+        for number in EMERGENCY_CONTACTS
+    ]
+    if not sends:
+        return
+
+    # Each send is an independent HTTP POST; issue them all at once so the
+    # alert goes out in roughly one round trip instead of one per message.
+    with ThreadPoolExecutor(max_workers=len(sends)) as ex:
+        futures = {
+            ex.submit(client.messages.create, body=body, from_=TWILIO_PHONE, to=number): number
+            for body, number in sends
+        }
+        for fut in as_completed(futures):
+            number = futures[fut]
             try:
-                body = f"Part {i}/{len(chunks)}: {chunk}" if len(chunks) > 1 else chunk
-                msg = client.messages.create(body=body, from_=TWILIO_PHONE, to=number)
+                msg = fut.result()
                 print(f"✅ Message sent to {number}, SID: {msg.sid}")
             except Exception as e:
                 print(f"❌ Failed to send message to {number}: {e}")
 
 def evaluate_alerts(heart_data, spo2_data):
-    alert_needed = False
-    reasons = []
+    """Check both series against the thresholds.
+
+    Returns (alert_needed, reasons, latest_hr, latest_spo2). ``reasons`` is a
+    generator, so the per-breach messages are only formatted if it is consumed.
+    """
+    import numpy as np
+
+    def values(series):
+        return np.fromiter((v for _, v, _ in series), dtype=np.float64, count=len(series))
 
     latest_hr = heart_data[-1][1] if heart_data else "N/A"
     latest_spo2 = spo2_data[-1][1] if spo2_data else "N/A"
 
-    for ts, hr_val in heart_data:
-        try:
-            if float(hr_val) <= HR_LOW_THRESHOLD:
-                reasons.append(f"Low HR {hr_val} bpm at {ts} (≤ {HR_LOW_THRESHOLD})")
-                alert_needed = True
-        except Exception:
-            continue
-
-    if HR_HIGH_THRESHOLD is not None:
-        for ts, hr_val in heart_data:
-            try:
-                if float(hr_val) >= HR_HIGH_THRESHOLD:
-                    reasons.append(f"High HR {hr_val} bpm at {ts} (≥ {HR_HIGH_THRESHOLD})")
-                    alert_needed = True
-            except Exception:
-                continue
+    def breaches():
+        # Masks are built one at a time so the any() below stops at the first breach.
+        hr_vals = values(heart_data)
+        yield heart_data, hr_vals <= HR_LOW_THRESHOLD, lambda ts, v: f"Low HR {v} bpm at {ts} (≤ {HR_LOW_THRESHOLD})"
+        if HR_HIGH_THRESHOLD is not None:
+            yield heart_data, hr_vals >= HR_HIGH_THRESHOLD, lambda ts, v: f"High HR {v} bpm at {ts} (≥ {HR_HIGH_THRESHOLD})"
+        sp_vals = values(spo2_data)
+        yield spo2_data, sp_vals <= SPO2_LOW_THRESHOLD, lambda ts, v: f"Low SpO₂ {v}% at {ts} (≤ {SPO2_LOW_THRESHOLD})"
 
-    for ts, sp_val in spo2_data:
-        try:
-            if float(sp_val) <= SPO2_LOW_THRESHOLD:
-                reasons.append(f"Low SpO₂ {sp_val}% at {ts} (≤ {SPO2_LOW_THRESHOLD})")
-                alert_needed = True
-        except Exception:
-            continue
+    alert_needed = any(mask.any() for _, mask, _ in breaches())
+
+    def iter_reasons():
+        for series, mask, reason in breaches():
+            for i in np.flatnonzero(mask):
+                ts, val, _ = series[i]
+                yield reason(ts, val)
 
-    return alert_needed, reasons, latest_hr, latest_spo2
+    return alert_needed, iter_reasons(), latest_hr, latest_spo2
 
 def main(days: int = 1, hospitals_link: str = "https://maps.google.com/?q=hospitals+near+me"):
-    creds = get_credentials()
-    service = build("fitness", "v1", credentials=creds)
-
-    heart_data = get_dataset(service, "heart_rate", days=days)
-    spo2_data = get_dataset(service, "oxygen_saturation", days=days)
-
-    print("\n📊 Heart Rate Data:")
-    for ts, v in heart_data:
-        print(f"{ts} → {v} bpm")
-    print("\n📊 SpO₂ Data:")
-    for ts, v in spo2_data:
-        print(f"{ts} → {v} %")
+    service = get_fit_service()
+
+    data = get_datasets(service, ("heart_rate", "oxygen_saturation"), days=days)
+    heart_data, spo2_data = data["heart_rate"], data["oxygen_saturation"]
+
+    # A single write for the whole dump instead of one print call per sample.
+    sys.stdout.write(
+        "\n📊 Heart Rate Data:\n" + "".join(f"{ts} → {v} bpm\n" for ts, v, _ in heart_data)
+        + "\n📊 SpO₂ Data:\n" + "".join(f"{ts} → {v} %\n" for ts, v, _ in spo2_data)
+    )
 
     save_to_csv(heart_data, spo2_data)
     save_to_cosmos(heart_data, spo2_data)